@@ -1,48 +1,173 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response, stream_with_context, send_file
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event, exc
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.wsgi import make_line_iter
+import csv
+import io
 import json
+import os
 import random
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import re
+import analytics
+import media
+import sharding
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///smart_home.db'
-db = SQLAlchemy(app)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///smart_home.db')
+app.config['MEDIA_ROOT'] = os.environ.get('MEDIA_ROOT', os.path.join(app.root_path, 'media'))
+app.config['HOUSEHOLD_SHARDS'] = os.environ.get('HOUSEHOLD_SHARDS')
+db = sharding.ShardedSQLAlchemy(app)
 migrate = Migrate(app, db)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
+camera_media = media.CameraManager(app.config['MEDIA_ROOT'])
 
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(120), nullable=False)
-    devices = db.relationship('Device', backref='owner', lazy=True)
+    # Devices may live in another database (see sharding.py), so there is no foreign key to join on
+    devices = db.relationship('Device', backref='owner', lazy=True,
+                              primaryjoin='User.id == foreign(Device.user_id)')
 
+class HouseholdShard(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    shard = db.Column(db.String(50), nullable=False)
+
+# Per-household tables; sharding.HouseholdSession routes them to the household's shard.
+# Their user_id has no foreign key, since the user table stays in the main database.
 class Device(db.Model):
+    __table_args__ = {'info': {'sharded': True}}
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
     type = db.Column(db.String(50), nullable=False)
     state = db.Column(db.String(50), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    # Set by remove_devices(); removed devices stay so their usage history can still be priced
+    removed_at = db.Column(db.DateTime)
+    state_events = db.relationship('DeviceStateEvent', backref='device', lazy=True)
+
+class DeviceStateEvent(db.Model):
+    __table_args__ = (
+        # Reports look up each device's events by time; see usage_rows()
+        db.Index('ix_device_state_event_device_id_changed_at', 'device_id', 'changed_at'),
+        {'info': {'sharded': True}}
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    state = db.Column(db.String(50), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
 
 class AutomationRule(db.Model):
+    __table_args__ = {'info': {'sharded': True}}
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
     trigger_device_id = db.Column(db.Integer, db.ForeignKey('device.id'))
     trigger_condition = db.Column(db.String(100))
     action_device_id = db.Column(db.Integer, db.ForeignKey('device.id'))
     action_state = db.Column(db.String(50))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+
+# Devices every new household starts with: (name, type, initial state)
+DEFAULT_DEVICES = [
+    ("Living Room Light", "light", "off"),
+    ("Home Thermostat", "thermostat", "72°F"),
+    ("Front Door Lock", "lock", "locked"),
+    ("Living Room Camera", "camera", "off"),
+    ("Living Room Speaker", "speaker", "off"),
+    ("Bedroom Fan", "fan", "off"),
+    ("Living Room Blinds", "blinds", "closed"),
+    ("Kitchen Outlet", "outlet", "off")
+]
+
+# Rows per executemany batch for bulk import/restore
+BULK_CHUNK_SIZE = 1000
+
+# Format version written in the household line of /snapshot exports
+SNAPSHOT_VERSION = 1
+
+DEVICE_EXPORT_FIELDS = ['id', 'name', 'type', 'state']
+RULE_EXPORT_FIELDS = ['id', 'name', 'trigger_device_id', 'trigger_condition', 'action_device_id', 'action_state']
+
+@event.listens_for(db.session, 'before_flush')
+def record_state_changes(session, flush_context, instances):
+    """Log every device state change so usage can be analysed over time."""
+    now = datetime.utcnow()
+    for obj in session.new:
+        if isinstance(obj, Device):
+            session.add(DeviceStateEvent(device=obj, user_id=obj.user_id, state=obj.state, changed_at=now))
+    for obj in session.dirty:
+        if isinstance(obj, Device):
+            history = db.inspect(obj).attrs.state.history
+            if history.added and history.deleted != history.added:
+                session.add(DeviceStateEvent(device=obj, user_id=obj.user_id, state=obj.state, changed_at=now))
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+def shard_for(user_id):
+    """Shard holding a household: its recorded placement, else its ring owner."""
+    placement = HouseholdShard.query.get(user_id)
+    return placement.shard if placement else db.ring.owner(user_id)
+
+def use_household(user_id):
+    """Route the session's device, rule and event statements to a household's shard."""
+    db.session.info['shard'] = shard_for(user_id)
+
+def place_household(user_id):
+    """Record a new household on its ring owner and select that shard."""
+    shard = db.ring.owner(user_id)
+    db.session.add(HouseholdShard(user_id=user_id, shard=shard))
+    db.session.info['shard'] = shard
+
+def resume_cameras(user_id=None):
+    """Start recorders for cameras whose stored state needs one, in every household or in one.
+
+    Recorders only live in process memory, so they are started again from
+    the device states when the app starts and after a snapshot restore.
+    """
+    selected = db.session.info.get('shard')
+    try:
+        for shard in [shard_for(user_id)] if user_id is not None else db.distinct_shards():
+            db.session.info['shard'] = shard
+            cameras = db.session.query(Device.id, Device.user_id, Device.state).filter(
+                Device.removed_at.is_(None),
+                Device.type == 'camera',
+                Device.state.in_(media.CameraManager.STATE_MODES)
+            )
+            if user_id is not None:
+                cameras = cameras.filter(Device.user_id == user_id)
+            try:
+                cameras = cameras.all()
+            except exc.SQLAlchemyError as e:
+                # A shard that cannot be read must not keep the app from serving requests
+                db.session.rollback()
+                print(f"Error resuming cameras on shard {shard}: {str(e)}")
+                continue
+            for device_id, owner, state in cameras:
+                try:
+                    camera_media.apply_state(media.camera_key(owner, device_id), state)
+                except Exception as e:
+                    print(f"Error resuming camera {device_id}: {str(e)}")
+    finally:
+        db.session.info['shard'] = selected
+
+@app.before_first_request
+def start_cameras():
+    resume_cameras()
+
+@app.before_request
+def select_household_shard():
+    if current_user.is_authenticated:
+        use_household(current_user.id)
+
 # Enhanced intent recognition with more sophisticated NLP
 def recognize_intent(message):
     message = message.lower()
@@ -64,7 +189,7 @@ def recognize_intent(message):
     return 'unknown'
 
 def handle_lights(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='light').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='light').first()
     if not device:
         return "No light device found.", None
     
@@ -102,7 +227,7 @@ def handle_lights(message, user_id):
     return f"The {device.name} is currently {device.state}. You can turn it on/off, adjust brightness, or change colors.", None
 
 def handle_temperature(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='thermostat').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='thermostat').first()
     if not device:
         return "No thermostat found.", None
         
@@ -117,7 +242,7 @@ def handle_temperature(message, user_id):
     return f"The current temperature is {device.state}.", None
 
 def handle_door(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='lock').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='lock').first()
     if not device:
         return "No door lock found.", None
     
@@ -136,7 +261,7 @@ def handle_door(message, user_id):
     return f"The {device.name} is currently {device.state}. Would you like me to lock or unlock it?", None
 
 def handle_speaker(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='speaker').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='speaker').first()
     if not device:
         return "No speaker found.", None
         
@@ -194,7 +319,7 @@ def handle_speaker(message, user_id):
     return f"The {device.name} is currently {device.state}. You can control power, playback, or volume.", None
 
 def handle_outlet(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='outlet').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='outlet').first()
     if not device:
         return "No smart plug found.", None
         
@@ -226,7 +351,7 @@ def handle_outlet(message, user_id):
     return f"The {device.name} is currently {device.state}.", None
 
 def handle_fan(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='fan').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='fan').first()
     if not device:
         return "No fan found.", None
         
@@ -270,7 +395,7 @@ def handle_fan(message, user_id):
     return f"The {device.name} is currently {device.state}. You can control power, speed, and oscillation.", None
 
 def handle_blinds(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='blinds').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='blinds').first()
     if not device:
         return "No blinds found.", None
         
@@ -303,7 +428,7 @@ def handle_blinds(message, user_id):
     return f"The {device.name} are currently {device.state}. You can open/close them or set a specific percentage.", None
 
 def handle_camera(message, user_id):
-    device = Device.query.filter_by(user_id=user_id, type='camera').first()
+    device = Device.query.filter_by(removed_at=None, user_id=user_id, type='camera').first()
     if not device:
         return "No camera found.", None
         
@@ -329,9 +454,8 @@ def handle_camera(message, user_id):
         db.session.commit()
         return f"Stopped recording on {device.name}.", {'device_id': device.id, 'state': 'standby'}
     elif 'take picture' in message or 'snapshot' in message:
-        device.state = 'snapshot'
-        db.session.commit()
-        return f"Took a snapshot with {device.name}.", {'device_id': device.id, 'state': 'snapshot'}
+        # A snapshot is a one-off capture; the camera keeps recording (or not) as before
+        return f"Took a snapshot with {device.name}.", {'device_id': device.id, 'state': device.state, 'action': 'snapshot'}
     
     # Handle motion detection
     elif 'motion detection' in message:
@@ -346,10 +470,42 @@ def handle_camera(message, user_id):
     
     return f"The {device.name} is currently {device.state}. You can control recording, take snapshots, or toggle motion detection.", None
 
+INTENT_HANDLERS = {
+    'lights': handle_lights,
+    'temperature': handle_temperature,
+    'door': handle_door,
+    'speaker': handle_speaker,
+    'fan': handle_fan,
+    'blinds': handle_blinds,
+    'camera': handle_camera,
+    'outlet': handle_outlet
+}
+
+def process_command(message, user_id):
+    """Route a chat message to its device handler; returns (response, device_update)."""
+    use_household(user_id)
+    intent = recognize_intent(message)
+    device_update = None
+
+    if intent in INTENT_HANDLERS:
+        response, device_update = INTENT_HANDLERS[intent](message, user_id)
+        if intent == 'camera' and device_update:
+            try:
+                camera_media.apply_state(media.camera_key(user_id, device_update['device_id']),
+                                         device_update.get('action', device_update['state']))
+            except Exception as e:
+                print(f"Error updating camera media: {str(e)}")
+    elif intent == 'automation':
+        response = handle_automation(message, user_id)
+    else:
+        response = "I'm not sure how to help with that. You can control these devices: lights, temperature, doors, speakers, fans, blinds, cameras, and outlets."
+
+    return response, device_update
+
 @app.route('/')
 @login_required
 def home():
-    devices = Device.query.filter_by(user_id=current_user.id).all()
+    devices = Device.query.filter_by(removed_at=None, user_id=current_user.id).all()
     return render_template('index.html', devices=devices)
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -378,22 +534,11 @@ def register():
         user = User(username=username)
         user.password_hash = generate_password_hash(password)
         db.session.add(user)
-        db.session.commit()
+        db.session.flush()  # Assigns user.id without a separate commit
+        place_household(user.id)
         
         # Create default devices for the new user
-        devices = [
-            Device(name="Living Room Light", type="light", state="off", user_id=user.id),
-            Device(name="Home Thermostat", type="thermostat", state="72°F", user_id=user.id),
-            Device(name="Front Door Lock", type="lock", state="locked", user_id=user.id),
-            Device(name="Living Room Camera", type="camera", state="off", user_id=user.id),
-            Device(name="Living Room Speaker", type="speaker", state="off", user_id=user.id),
-            Device(name="Bedroom Fan", type="fan", state="off", user_id=user.id),
-            Device(name="Living Room Blinds", type="blinds", state="closed", user_id=user.id),
-            Device(name="Kitchen Outlet", type="outlet", state="off", user_id=user.id)
-        ]
-        
-        for device in devices:
-            db.session.add(device)
+        add_default_devices(user.id)
         db.session.commit()
         
         flash('Registration successful! Please login.')
@@ -408,26 +553,7 @@ def chat():
         data = request.json
         user_message = data['message']
         
-        intent = recognize_intent(user_message)
-        device_update = None
-        
-        handlers = {
-            'lights': handle_lights,
-            'temperature': handle_temperature,
-            'door': handle_door,
-            'speaker': handle_speaker,
-            'fan': handle_fan,
-            'blinds': handle_blinds,
-            'camera': handle_camera,
-            'outlet': handle_outlet
-        }
-        
-        if intent in handlers:
-            response, device_update = handlers[intent](user_message, current_user.id)
-        elif intent == 'automation':
-            response = handle_automation(user_message, current_user.id)
-        else:
-            response = "I'm not sure how to help with that. You can control these devices: lights, temperature, doors, speakers, fans, blinds, cameras, and outlets."
+        response, device_update = process_command(user_message, current_user.id)
 
         return jsonify({
             'response': response,
@@ -460,19 +586,21 @@ def devices():  # Changed from manage_devices to devices
             return jsonify({'success': True})
         return redirect(url_for('devices'))
         
-    devices = Device.query.filter_by(user_id=current_user.id).all()
+    devices = Device.query.filter_by(removed_at=None, user_id=current_user.id).all()
     return render_template('devices.html', devices=devices)
 
 @app.route('/devices/<int:device_id>', methods=['DELETE'])
 @login_required
 def delete_device(device_id):
     try:
-        device = Device.query.filter_by(id=device_id, user_id=current_user.id).first()
+        device = Device.query.filter_by(removed_at=None, id=device_id, user_id=current_user.id).first()
         if not device:
             return jsonify({'success': False, 'error': 'Device not found'}), 404
         
-        db.session.delete(device)
+        remove_devices(current_user.id, [device.id])
         db.session.commit()
+        if device.type == 'camera':
+            camera_media.stop(media.camera_key(current_user.id, device_id))
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
@@ -482,7 +610,7 @@ def delete_device(device_id):
 @app.route('/devices/<int:device_id>', methods=['PUT'])
 @login_required
 def update_device(device_id):
-    device = Device.query.filter_by(id=device_id, user_id=current_user.id).first()
+    device = Device.query.filter_by(removed_at=None, id=device_id, user_id=current_user.id).first()
     if not device:
         return jsonify({'error': 'Device not found'}), 404
 
@@ -521,31 +649,463 @@ def automation():
         return redirect(url_for('automation'))
         
     rules = AutomationRule.query.filter_by(user_id=current_user.id).all()
-    devices = Device.query.filter_by(user_id=current_user.id).all()
+    devices = Device.query.filter_by(removed_at=None, user_id=current_user.id).all()
     return render_template('automation.html', rules=rules, devices=devices)
 
+def add_default_devices(user_id):
+    """Insert the default device set for a user in one batch (caller commits)."""
+    bulk_insert(Device.__table__, (
+        {'name': name, 'type': device_type, 'state': state, 'user_id': user_id}
+        for name, device_type, state in DEFAULT_DEVICES
+    ))
+    record_initial_states([user_id])
+
 def create_default_devices():
     user = User.query.first()
-    if user and not Device.query.filter_by(user_id=user.id).first():
-        devices = [
-            Device(name="Living Room Light", type="light", state="off", user_id=user.id),
-            Device(name="Home Thermostat", type="thermostat", state="72°F", user_id=user.id),
-            Device(name="Front Door Lock", type="lock", state="locked", user_id=user.id),
-            Device(name="Living Room Camera", type="camera", state="off", user_id=user.id),
-            Device(name="Living Room Speaker", type="speaker", state="off", user_id=user.id),
-            Device(name="Bedroom Fan", type="fan", state="off", user_id=user.id),
-            Device(name="Living Room Blinds", type="blinds", state="closed", user_id=user.id),
-            Device(name="Kitchen Outlet", type="outlet", state="off", user_id=user.id)
-        ]
-        
-        for device in devices:
-            db.session.add(device)
+    if user:
+        use_household(user.id)
+    if user and not Device.query.filter_by(removed_at=None, user_id=user.id).first():
+        add_default_devices(user.id)
+        db.session.commit()
+
+def bulk_insert(table, rows, chunk_size=BULK_CHUNK_SIZE):
+    """Insert an iterable of row dicts as chunked executemany batches.
+
+    Only one chunk is held in memory at a time, so arbitrarily large
+    generators can be consumed. Returns the number of rows inserted.
+    The caller owns the transaction.
+    """
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            db.session.execute(table.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+def record_initial_states(user_ids, chunk_size=BULK_CHUNK_SIZE):
+    """Log the starting state of these households' devices that have no history yet.
+
+    Core inserts skip the before_flush hook, so callers of bulk_insert() on
+    the device table use this instead; without a first event, analytics
+    cannot tell when a device was added or what state it started in. Runs
+    as one INSERT ... SELECT per chunk of users (caller commits).
+    """
+    devices = Device.__table__
+    events = DeviceStateEvent.__table__
+    now = datetime.utcnow()
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), chunk_size):
+        first_states = db.select([
+            devices.c.id, devices.c.user_id, devices.c.state, db.literal(now, db.DateTime)
+        ]).where(devices.c.user_id.in_(user_ids[i:i + chunk_size])).where(
+            ~db.exists().where(events.c.device_id == devices.c.id)
+        )
+        db.session.execute(events.insert().from_select(
+            ['device_id', 'user_id', 'state', 'changed_at'], first_states
+        ))
+
+def remove_devices(user_id, device_ids=None):
+    """Remove a household's devices, or just ``device_ids``, keeping their rows.
+
+    Usage is billed from the state history, which needs each device's type,
+    so devices are tombstoned instead of deleted: they log a final
+    ``removed`` state, which draws nothing, and get ``removed_at`` set,
+    which every household query filters on. Runs as two Core statements
+    however many devices go (caller commits). Returns the number removed.
+    """
+    devices = Device.__table__
+    events = DeviceStateEvent.__table__
+    now = datetime.utcnow()
+    criteria = [devices.c.user_id == user_id, devices.c.removed_at.is_(None)]
+    if device_ids is not None:
+        criteria.append(devices.c.id.in_(device_ids))
+    db.session.execute(events.insert().from_select(
+        ['device_id', 'user_id', 'state', 'changed_at'],
+        db.select([devices.c.id, devices.c.user_id, db.literal(analytics.REMOVED_STATE),
+                   db.literal(now, db.DateTime)]).where(db.and_(*criteria))
+    ))
+    removed = db.session.execute(devices.update().where(db.and_(*criteria))
+                                 .values(state=analytics.REMOVED_STATE, removed_at=now))
+    return removed.rowcount
+
+def iter_request_lines():
+    """Yield decoded lines, endings included, from the request body without buffering it.
+
+    A leading UTF-8 byte order mark, as Excel writes at the start of CSV
+    exports, is dropped.
+    """
+    encoding = 'utf-8-sig'
+    for line in make_line_iter(request.stream, limit=request.content_length):
+        yield line.decode(encoding)
+        encoding = 'utf-8'
+
+def iter_import_records(fmt):
+    """Yield dicts parsed from an NDJSON or CSV request body, one line at a time."""
+    if fmt == 'csv':
+        # The CSV reader gets the lines untouched, so quoted fields may span lines
+        yield from csv.DictReader(iter_request_lines())
+    else:
+        for line in iter_request_lines():
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Each NDJSON line must be a JSON object')
+            yield record
+
+def request_format(default='ndjson'):
+    fmt = request.args.get('format')
+    if fmt:
+        return fmt.lower()
+    if request.mimetype == 'text/csv':
+        return 'csv'
+    return default
+
+def record_field(record, field, line_no, kind=str, required=False):
+    """Read one field of an import record, rejecting values of the wrong type.
+
+    Empty values count as missing. Raises ValueError, which the import
+    routes turn into a 400.
+    """
+    value = record.get(field)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f"Record {line_no}: '{field}' is required")
+        return None
+    # bool is an int subclass, but True is not a device id
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise ValueError(f"Record {line_no}: '{field}' must be of type {kind.__name__}")
+    return value
+
+def device_fields(record, line_no, user_id):
+    return {
+        'name': record_field(record, 'name', line_no, required=True),
+        'type': record_field(record, 'type', line_no, required=True),
+        'state': record_field(record, 'state', line_no) or 'off',
+        'user_id': user_id
+    }
+
+def device_rows_from_records(records, user_id):
+    for line_no, record in enumerate(records, start=1):
+        yield device_fields(record, line_no, user_id)
+
+def ndjson_line(record):
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+def csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+def stream_rows(query):
+    """Iterate a query in BULK_CHUNK_SIZE batches instead of loading every row."""
+    return query.yield_per(BULK_CHUNK_SIZE)
+
+def device_record(device):
+    return {field: getattr(device, field) for field in DEVICE_EXPORT_FIELDS}
+
+def rule_record(rule):
+    return {field: getattr(rule, field) for field in RULE_EXPORT_FIELDS}
+
+@app.route('/devices/import', methods=['POST'])
+@login_required
+def import_devices():
+    fmt = request_format()
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'success': False, 'error': f'Unsupported format: {fmt}'}), 400
+
+    try:
+        rows = device_rows_from_records(iter_import_records(fmt), current_user.id)
+        imported = bulk_insert(Device.__table__, rows)
+        record_initial_states([current_user.id])
         db.session.commit()
+        return jsonify({'success': True, 'imported': imported})
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/devices/export')
+@login_required
+def export_devices():
+    fmt = request_format()
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'success': False, 'error': f'Unsupported format: {fmt}'}), 400
+
+    query = Device.query.filter_by(removed_at=None, user_id=current_user.id).order_by(Device.id)
+
+    def generate():
+        if fmt == 'csv':
+            yield csv_line(DEVICE_EXPORT_FIELDS)
+            for device in stream_rows(query):
+                yield csv_line([getattr(device, field) for field in DEVICE_EXPORT_FIELDS])
+        else:
+            for device in stream_rows(query):
+                yield ndjson_line(device_record(device))
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+@app.route('/snapshot')
+@login_required
+def export_snapshot():
+    user_id = current_user.id
+    username = current_user.username
+
+    def generate():
+        yield ndjson_line({
+            'kind': 'household',
+            'version': SNAPSHOT_VERSION,
+            'username': username,
+            'exported_at': datetime.utcnow().isoformat()
+        })
+        # Devices come first so a restore can map rule device ids in one pass
+        for device in stream_rows(Device.query.filter_by(removed_at=None, user_id=user_id).order_by(Device.id)):
+            yield ndjson_line(dict(device_record(device), kind='device'))
+        for rule in stream_rows(AutomationRule.query.filter_by(user_id=user_id).order_by(AutomationRule.id)):
+            yield ndjson_line(dict(rule_record(rule), kind='rule'))
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def restore_snapshot(records, user_id):
+    """Replace a user's devices and rules with the records of a snapshot.
+
+    Devices receive fresh ids; rule references are remapped through the
+    old-to-new id table. The replaced devices are removed, not deleted, so
+    the household's usage history is kept. The first record must be the ``household`` line of
+    a snapshot in a supported version; nothing is deleted until it has been
+    read. Nothing is committed here, so the caller can roll the whole
+    restore back on error.
+    """
+    records = iter(records)
+    header = next(records, None)
+    if header is None or header.get('kind') != 'household':
+        raise ValueError("Record 1: a snapshot must start with its 'household' record")
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Record 1: unsupported snapshot version {header.get('version')!r}")
+
+    AutomationRule.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    remove_devices(user_id)
+
+    id_map = {}
+    pending_devices = []
+    pending_rules = []
+    counts = {'devices': 0, 'rules': 0}
+
+    def flush_devices():
+        if not pending_devices:
+            return
+        old_ids = [old_id for old_id, _ in pending_devices]
+        mappings = [mapping for _, mapping in pending_devices]
+        # return_defaults populates each mapping's new primary key
+        db.session.bulk_insert_mappings(Device, mappings, return_defaults=True)
+        for old_id, mapping in zip(old_ids, mappings):
+            if old_id is not None:
+                id_map[old_id] = mapping['id']
+        counts['devices'] += len(mappings)
+        pending_devices.clear()
+
+    def flush_rules():
+        if pending_rules:
+            counts['rules'] += bulk_insert(AutomationRule.__table__, pending_rules)
+            pending_rules.clear()
+
+    def remap(device_id, line_no):
+        if device_id is None:
+            return None
+        if device_id not in id_map:
+            raise ValueError(f"Record {line_no}: rule references unknown device {device_id}")
+        return id_map[device_id]
+
+    for line_no, record in enumerate(records, start=2):
+        kind = record.get('kind')
+        if kind == 'device':
+            pending_devices.append((record_field(record, 'id', line_no, int),
+                                    device_fields(record, line_no, user_id)))
+            if len(pending_devices) >= BULK_CHUNK_SIZE:
+                flush_devices()
+        elif kind == 'rule':
+            name = record_field(record, 'name', line_no, required=True)
+            flush_devices()
+            pending_rules.append({
+                'name': name,
+                'trigger_device_id': remap(record_field(record, 'trigger_device_id', line_no, int), line_no),
+                'trigger_condition': record_field(record, 'trigger_condition', line_no),
+                'action_device_id': remap(record_field(record, 'action_device_id', line_no, int), line_no),
+                'action_state': record_field(record, 'action_state', line_no),
+                'user_id': user_id
+            })
+            if len(pending_rules) >= BULK_CHUNK_SIZE:
+                flush_rules()
+        else:
+            raise ValueError(f"Record {line_no}: unknown kind {kind!r}")
+
+    flush_devices()
+    flush_rules()
+    # bulk_insert_mappings bypasses the session hooks as well
+    record_initial_states([user_id])
+    return counts, id_map, header
+
+@app.route('/snapshot/restore', methods=['POST'])
+@login_required
+def restore_snapshot_route():
+    user_id = current_user.id
+    cameras = [device_id for (device_id,) in
+               db.session.query(Device.id).filter_by(removed_at=None, user_id=user_id, type='camera')]
+    try:
+        counts, id_map, header = restore_snapshot(iter_import_records('ndjson'), user_id)
+        db.session.commit()
+    except (ValueError, UnicodeDecodeError) as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    # The replaced cameras are removed: stop their recorders. When the snapshot is this
+    # household's own, its ids are our old ids, so each camera's media follows it to its new id.
+    for device_id in cameras:
+        camera_media.stop(media.camera_key(user_id, device_id))
+    if header.get('username') == current_user.username:
+        try:
+            with camera_media.lock_household(user_id):
+                for old_id in cameras:
+                    if old_id in id_map:
+                        camera_media.rename(media.camera_key(user_id, old_id), media.camera_key(user_id, id_map[old_id]))
+        except RuntimeError as e:
+            print(f"Error moving camera media: {str(e)}")
+    resume_cameras(user_id)
+    return jsonify(dict(counts, success=True))
+
+def parse_utc(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def parse_report_window():
+    """Read ?since=&until= (ISO 8601, UTC) or ?hours= into a (since, until) pair.
+
+    Times with an offset are converted to naive UTC, which is how events are
+    stored; times without one are taken as UTC.
+    """
+    until = parse_utc(request.args['until']) if 'until' in request.args else datetime.utcnow()
+    if 'since' in request.args:
+        since = parse_utc(request.args['since'])
+    else:
+        hours = float(request.args.get('hours', 24))
+        if not 0 < hours <= analytics.MAX_REPORT_HOURS:
+            raise ValueError(f"'hours' must be between 0 and {analytics.MAX_REPORT_HOURS}")
+        since = until - timedelta(hours=hours)
+    if since >= until:
+        raise ValueError("'since' must be before 'until'")
+    return since, until
+
+def usage_rows(since, until, user_id=None):
+    """Rows of the selected shard needed to price ``[since, until)``.
+
+    Returns ``(devices, events, logged)`` as analytics.intervals_from_rows
+    takes them: ``(id, user_id, type, state)`` device rows; the events
+    inside the window plus each device's last event before it, sorted by
+    device and time; and the ids of devices with any event at all. Events
+    are read through the (device_id, changed_at) index, so the cost follows
+    the window and the device count rather than the length of the history.
+    """
+    logged = db.exists().where(DeviceStateEvent.device_id == Device.id)
+    device_query = db.session.query(Device.id, Device.user_id, Device.type, Device.state, logged.label('logged'))
+    device_query = device_query.filter(db.or_(Device.removed_at.is_(None), Device.removed_at >= since))
+    if user_id is not None:
+        device_query = device_query.filter(Device.user_id == user_id)
+    rows = device_query.order_by(Device.id).all()
+
+    earlier = db.aliased(DeviceStateEvent)
+    entered_at = db.session.query(db.func.max(earlier.changed_at)).filter(
+        earlier.device_id == Device.id,
+        earlier.changed_at < since
+    ).scalar_subquery()
+    event_queries = [
+        db.session.query(DeviceStateEvent.device_id, DeviceStateEvent.state, DeviceStateEvent.changed_at)
+        .join(Device, Device.id == DeviceStateEvent.device_id).filter(*criteria)
+        for criteria in (
+            (DeviceStateEvent.changed_at == entered_at,),
+            (DeviceStateEvent.changed_at >= since, DeviceStateEvent.changed_at < until)
+        )
+    ]
+    if user_id is not None:
+        event_queries = [query.filter(Device.user_id == user_id) for query in event_queries]
+    events = sorted((row for query in event_queries for row in query), key=lambda row: (row[0], row[2]))
+
+    devices = [(device_id, owner, device_type, state) for device_id, owner, device_type, state, _ in rows]
+    return devices, events, {row[0] for row in rows if row[4]}
+
+@app.route('/analytics/energy')
+@login_required
+def energy_analytics():
+    try:
+        since, until = parse_report_window()
+    except (ValueError, OverflowError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    devices, events, logged = usage_rows(since, until, current_user.id)
+    data = analytics.intervals_from_rows(devices, events, until, since, logged)
+    energy_wh, on_seconds = analytics.compute_usage(
+        data['device_index'], data['type_codes'], data['state_codes'], data['starts'], data['ends'],
+        data['type_names'], data['state_names'], since=analytics.utc_timestamp(since),
+        until=analytics.utc_timestamp(until), device_count=len(devices)
+    )
+
+    names = dict(db.session.query(Device.id, Device.name).filter(Device.user_id == current_user.id))
+    return jsonify({
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'total_kwh': round(float(energy_wh.sum()) / 1000, 4),
+        'devices': [{
+            'id': device_id,
+            'name': names.get(device_id),
+            'type': device_type,
+            'energy_wh': round(float(wh), 2),
+            'on_seconds': round(float(seconds))
+        } for (device_id, _, device_type, _), wh, seconds in zip(devices, energy_wh, on_seconds)]
+    })
+
+@app.route('/cameras/<int:device_id>/segments')
+@login_required
+def camera_segments(device_id):
+    device = Device.query.filter_by(removed_at=None, id=device_id, user_id=current_user.id, type='camera').first()
+    if not device:
+        return jsonify({'error': 'Camera not found'}), 404
+    return jsonify(camera_media.segments(media.camera_key(current_user.id, device_id)))
+
+@app.route('/cameras/<int:device_id>/segments/<segment_id>')
+@login_required
+def camera_segment(device_id, segment_id):
+    device = Device.query.filter_by(removed_at=None, id=device_id, user_id=current_user.id, type='camera').first()
+    if not device:
+        return jsonify({'error': 'Camera not found'}), 404
+    path = camera_media.segment_path(media.camera_key(current_user.id, device_id), segment_id)
+    if not path:
+        return jsonify({'error': 'Segment not found'}), 404
+    # conditional=True honours Range headers; the file is streamed in blocks
+    return send_file(path, mimetype='application/octet-stream', conditional=True)
+
+@app.route('/cameras/stats')
+@login_required
+def camera_stats():
+    owned = {
+        media.camera_key(current_user.id, device_id): device_id
+        for (device_id,) in db.session.query(Device.id).filter_by(removed_at=None, user_id=current_user.id, type='camera')
+    }
+    return jsonify({
+        str(owned[camera_id]): stats for camera_id, stats in camera_media.stats().items() if camera_id in owned
+    })
 
 @app.route('/get_devices')
 @login_required
 def get_devices():
-    devices = Device.query.filter_by(user_id=current_user.id).all()
+    devices = Device.query.filter_by(removed_at=None, user_id=current_user.id).all()
     return jsonify([{
         'id': device.id,
         'name': device.name,
@@ -0,0 +1,67 @@
+"""Benchmark onboarding a large property through the streaming bulk endpoints.
+
+Run from the project directory:
+
+    python -m benchmarks.bulk_import --devices 10000
+
+It uses a throwaway SQLite file, so the real smart_home.db is never touched.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+
+def device_lines(count):
+    types = ['light', 'thermostat', 'lock', 'camera', 'speaker', 'fan', 'blinds', 'outlet']
+    for i in range(count):
+        device_type = types[i % len(types)]
+        yield json.dumps({'name': f'Unit {i // 8} {device_type}', 'type': device_type, 'state': 'off'}) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=10000)
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(db_dir, 'bench.db')
+
+    from app import app, db
+
+    with app.app_context():
+        db.create_all()
+
+    client = app.test_client()
+    client.post('/register', data={'username': 'bench', 'password': 'bench'})
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+    body = ''.join(device_lines(args.devices)).encode('utf-8')
+
+    start = time.perf_counter()
+    response = client.post('/devices/import', data=body, content_type='application/x-ndjson')
+    import_seconds = time.perf_counter() - start
+    print(f"bulk import:  {response.get_json()['imported']} devices in {import_seconds:.2f}s")
+
+    start = time.perf_counter()
+    snapshot = client.get('/snapshot').get_data()
+    export_seconds = time.perf_counter() - start
+    print(f"snapshot:     {len(snapshot.splitlines())} records in {export_seconds:.2f}s")
+
+    start = time.perf_counter()
+    response = client.post('/snapshot/restore', data=snapshot, content_type='application/x-ndjson')
+    restore_seconds = time.perf_counter() - start
+    print(f"restore:      {response.get_json()['devices']} devices in {restore_seconds:.2f}s")
+
+    # Baseline: the old one-device-per-request path, sampled and extrapolated
+    sample = min(args.devices, 200)
+    start = time.perf_counter()
+    for i in range(sample):
+        client.post('/devices', json={'name': f'Single {i}', 'type': 'light'})
+    single_seconds = (time.perf_counter() - start) / sample * args.devices
+    print(f"per-request:  ~{single_seconds:.2f}s estimated for {args.devices} devices")
+
+
+if __name__ == '__main__':
+    main()
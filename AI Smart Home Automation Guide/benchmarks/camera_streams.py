@@ -0,0 +1,60 @@
+"""Measure the CPU and memory cost of simulated camera streams.
+
+Run from the project directory:
+
+    python -m benchmarks.camera_streams --cameras 36 --seconds 30
+
+Every camera runs in motion-detection mode on a synthetic source, writing
+into its own ring buffer under a throwaway media root.
+"""
+import argparse
+import resource
+import shutil
+import tempfile
+import time
+
+from media import CameraManager
+
+
+def rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cameras', type=int, default=36)
+    parser.add_argument('--seconds', type=float, default=30.0)
+    parser.add_argument('--fps', type=int, default=10)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    manager = CameraManager(root, fps=args.fps, motion_period=10.0)
+    baseline_rss = rss_mb()
+    cpu_start = time.process_time()
+
+    try:
+        for camera_id in range(args.cameras):
+            manager.apply_state(camera_id, 'motion_detection')
+        time.sleep(args.seconds)
+        stats = manager.stats()
+        cpu_seconds = time.process_time() - cpu_start
+    finally:
+        manager.stop_all()
+
+    clips = sum(len(manager.segments(camera_id)) for camera_id in range(args.cameras))
+    fps = [s['fps'] for s in stats.values()]
+    stream_cpu = [s['cpu_percent'] for s in stats.values()]
+    print(f"cameras:            {args.cameras} at {args.fps} fps target")
+    print(f"achieved fps:       min {min(fps):.1f}, mean {sum(fps) / len(fps):.1f}")
+    print(f"capture CPU/stream: {sum(stream_cpu) / len(stream_cpu):.2f}% of a core")
+    print(f"process CPU total:  {100 * cpu_seconds / args.seconds:.1f}% of a core")
+    print(f"peak RSS growth:    {rss_mb() - baseline_rss:.1f} MB "
+          f"({(rss_mb() - baseline_rss) / args.cameras:.2f} MB/stream)")
+    print(f"ring buffer/stream: {stats[0]['ring_bytes'] / 2 ** 20:.1f} MB on disk")
+    print(f"motion clips:       {clips}")
+    shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
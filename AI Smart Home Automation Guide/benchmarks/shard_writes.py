@@ -0,0 +1,103 @@
+"""Measure device-state write throughput as household shards are added.
+
+Run from the project directory:
+
+    python -m benchmarks.shard_writes --shards 1 2 4 8 --processes 8
+
+For each shard count a fresh set of SQLite files is created, households are
+provisioned across the shards, and ``--processes`` writer processes toggle
+lights through ``process_command`` for ``--seconds``. Throughput can only
+scale while there are free cores, so give it a multi-core box.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# How long past --seconds to wait for a writer to report before giving up on it
+REPORT_GRACE = 60.0
+
+
+def writer(user_ids, seconds, counts):
+    writes = busy = 0
+    try:
+        from sqlalchemy.exc import OperationalError
+        from app import app, db, process_command
+
+        with app.app_context():
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                for user_id in user_ids:
+                    try:
+                        process_command('Turn on the lights' if writes % 2 else 'Turn off the lights', user_id)
+                    except OperationalError:
+                        # SQLite gave up waiting for the shard's write lock; count it and carry on
+                        db.session.rollback()
+                        busy += 1
+                        continue
+                    writes += 1
+    finally:
+        # Report even when the writer dies, so run_one is not left waiting
+        counts.put((writes, busy))
+
+
+def run_one(shards, homes, processes, seconds):
+    """Benchmark a single shard count; expects DATABASE_URL/HOUSEHOLD_SHARDS in the environment."""
+    from simulator import provision_homes
+
+    _, user_ids = provision_homes(homes, run_id=0)
+    context = multiprocessing.get_context('spawn')
+    counts = context.Queue()
+    workers = [context.Process(target=writer, args=(user_ids[i::processes], seconds, counts))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        results = [counts.get(timeout=seconds + REPORT_GRACE) for _ in workers]
+    except queue.Empty:
+        for worker in workers:
+            worker.terminate()
+        raise SystemExit(f'{shards} shard(s): a writer process did not report back')
+    for worker in workers:
+        worker.join()
+    total = sum(writes for writes, _ in results)
+    busy = sum(busy for _, busy in results)
+    failed = sum(1 for worker in workers if worker.exitcode)
+    print(f'{shards} shard(s): {total / seconds:.0f} writes/s, {busy} busy errors'
+          + (f', {failed} writer(s) failed' if failed else ''), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--homes', type=int, default=800)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_one(args.shards[0], args.homes, args.processes, args.seconds)
+        return
+
+    for count in args.shards:
+        root = tempfile.mkdtemp()
+        env = dict(os.environ)
+        env['DATABASE_URL'] = 'sqlite:///' + os.path.join(root, 'directory.db')
+        env['HOUSEHOLD_SHARDS'] = ','.join(
+            f'shard{i}=sqlite:///' + os.path.join(root, f'shard{i}.db') for i in range(count)
+        )
+        # A fresh interpreter per run, since the shard list is read at import time
+        subprocess.run([sys.executable, '-m', 'benchmarks.shard_writes', '--single',
+                        '--shards', str(count), '--homes', str(args.homes),
+                        '--processes', str(args.processes), '--seconds', str(args.seconds)],
+                       env=env, check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,518 @@
+"""Camera media pipeline: frame capture, on-disk ring buffers and clip segments.
+
+Each camera owns a recorder thread that pulls frames from a pluggable frame
+source and writes them into a fixed-size memory-mapped ring buffer on disk,
+so a camera's memory use stays bounded however long it runs. Snapshots and
+clips (motion-triggered or continuous recording) are copied out of the ring
+into segment files, and each camera keeps an append-only ``index.ndjson``
+listing its segments.
+
+Layout under the media root, where ``camera_id`` is a ``camera_key``::
+
+    <root>/<camera_id>/ring.buf
+    <root>/<camera_id>/index.ndjson
+    <root>/<camera_id>/segments/<segment_id>.seg
+    <root>/<user_id>.lock    (held by the household's running recorders)
+
+A segment file is a sequence of frame records, each a ``FRAME_HEADER``
+(capture time, payload length) followed by the raw frame bytes.
+"""
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+
+import numpy as np
+
+RING_MAGIC = b'SHRB'
+# magic, version, slot count, slot size, width, height, next sequence number
+RING_HEADER = struct.Struct('<4sIIIIIQ')
+# capture time, sequence number, payload length
+SLOT_HEADER = struct.Struct('<dQI')
+FRAME_HEADER = struct.Struct('<dI')
+
+DEFAULT_WIDTH = 320
+DEFAULT_HEIGHT = 240
+DEFAULT_FPS = 10
+DEFAULT_RING_SECONDS = 10
+
+# Mean absolute pixel difference between consecutive frames that counts as motion
+MOTION_THRESHOLD = 8.0
+
+
+class SyntheticFrameSource:
+    """Generates 8-bit grayscale frames locally, for development and load tests.
+
+    A static noisy gradient is shown, and every ``motion_period`` seconds a
+    bright square moves across the frame for ``motion_duration`` seconds, so
+    motion detection has something to trigger on.
+    """
+
+    def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, fps=DEFAULT_FPS,
+                 motion_period=20.0, motion_duration=3.0, seed=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.motion_period = motion_period
+        self.motion_duration = motion_duration
+        self.rng = np.random.default_rng(seed)
+        gradient = np.linspace(40, 120, width, dtype=np.float32)
+        self.background = np.broadcast_to(gradient, (height, width)).astype(np.uint8)
+        self.started = time.time()
+
+    def read(self):
+        """Return ``(timestamp, frame_bytes)`` for the next frame."""
+        now = time.time()
+        frame = self.background + self.rng.integers(0, 4, self.background.shape, dtype=np.uint8)
+        phase = (now - self.started) % self.motion_period
+        if phase < self.motion_duration:
+            size = self.height // 4
+            x = int((self.width - size) * phase / self.motion_duration)
+            y = (self.height - size) // 2
+            frame[y:y + size, x:x + size] = 250
+        return now, frame.tobytes()
+
+    def close(self):
+        pass
+
+
+# Frame source factories by name; register real camera drivers here
+FRAME_SOURCES = {
+    'synthetic': SyntheticFrameSource
+}
+
+
+class RingBuffer:
+    """Fixed-size circular frame store backed by a memory-mapped file.
+
+    The file holds a header and ``slot_count`` slots of ``slot_size`` bytes.
+    Frame ``n`` lives in slot ``n % slot_count``; the header records the next
+    sequence number so the ring survives restarts.
+    """
+
+    def __init__(self, path, slot_count, slot_size, width=0, height=0):
+        self.path = path
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.stride = SLOT_HEADER.size + slot_size
+        size = RING_HEADER.size + self.stride * slot_count
+        self.lock = threading.Lock()
+
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        self.file = open(path, 'r+b' if not fresh else 'w+b')
+        if fresh:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+        if fresh:
+            self.next_seq = 0
+            self._write_header(width, height)
+        else:
+            magic, _, count, slot, self.width, self.height, self.next_seq = RING_HEADER.unpack_from(self.map, 0)
+            if magic != RING_MAGIC or count != slot_count or slot != slot_size:
+                self.next_seq = 0
+                self._write_header(width, height)
+
+    def _write_header(self, width, height):
+        self.width = width
+        self.height = height
+        RING_HEADER.pack_into(self.map, 0, RING_MAGIC, 1, self.slot_count, self.slot_size,
+                              width, height, self.next_seq)
+
+    def _offset(self, seq):
+        return RING_HEADER.size + (seq % self.slot_count) * self.stride
+
+    def write(self, timestamp, frame):
+        """Store a frame, overwriting the oldest one. Returns its sequence number."""
+        if len(frame) > self.slot_size:
+            raise ValueError(f'Frame of {len(frame)} bytes exceeds slot size {self.slot_size}')
+        with self.lock:
+            seq = self.next_seq
+            offset = self._offset(seq)
+            SLOT_HEADER.pack_into(self.map, offset, timestamp, seq, len(frame))
+            start = offset + SLOT_HEADER.size
+            self.map[start:start + len(frame)] = frame
+            self.next_seq = seq + 1
+            struct.pack_into('<Q', self.map, RING_HEADER.size - 8, self.next_seq)
+            return seq
+
+    def read(self, seq):
+        """Return ``(timestamp, frame)`` for a sequence number, or None if overwritten."""
+        with self.lock:
+            if seq >= self.next_seq or seq < self.next_seq - self.slot_count:
+                return None
+            offset = self._offset(seq)
+            timestamp, stored_seq, length = SLOT_HEADER.unpack_from(self.map, offset)
+            if stored_seq != seq:
+                return None
+            start = offset + SLOT_HEADER.size
+            return timestamp, bytes(self.map[start:start + length])
+
+    def latest(self):
+        return self.read(self.next_seq - 1) if self.next_seq else None
+
+    def recent(self, count):
+        """Yield up to ``count`` of the newest frames, oldest first."""
+        first = max(0, self.next_seq - min(count, self.slot_count))
+        for seq in range(first, self.next_seq):
+            frame = self.read(seq)
+            if frame is not None:
+                yield frame
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class SegmentWriter:
+    """Appends frames to a segment file and records it in the camera index."""
+
+    def __init__(self, camera_dir, kind, width, height):
+        self.camera_dir = camera_dir
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.width = width
+        self.height = height
+        self.path = os.path.join(camera_dir, 'segments', f'{self.id}.seg')
+        self.file = open(self.path, 'wb')
+        self.frames = 0
+        self.started_at = None
+        self.ended_at = None
+
+    def write(self, timestamp, frame):
+        self.file.write(FRAME_HEADER.pack(timestamp, len(frame)))
+        self.file.write(frame)
+        self.frames += 1
+        if self.started_at is None:
+            self.started_at = timestamp
+        self.ended_at = timestamp
+
+    def close(self):
+        self.file.close()
+        entry = {
+            'id': self.id,
+            'kind': self.kind,
+            'started_at': self.started_at,
+            'ended_at': self.ended_at,
+            'frames': self.frames,
+            'bytes': os.path.getsize(self.path),
+            'width': self.width,
+            'height': self.height
+        }
+        with open(os.path.join(self.camera_dir, 'index.ndjson'), 'a') as index:
+            index.write(json.dumps(entry) + '\n')
+        return entry
+
+
+class CameraRecorder:
+    """Capture loop for one camera.
+
+    ``mode`` is one of ``'idle'`` (buffer only), ``'motion'`` (write a clip
+    while motion is detected, with pre- and post-roll) or ``'record'``
+    (continuous clips rotated every ``segment_seconds``).
+    """
+
+    def __init__(self, camera_dir, source, ring_seconds=DEFAULT_RING_SECONDS,
+                 pre_roll_seconds=2.0, post_roll_seconds=3.0, segment_seconds=60.0, lock_path=None):
+        # A shared lock on lock_path for the recorder's lifetime; see CameraManager.lock_household
+        self.lock_file = None
+        if lock_path:
+            self.lock_file = open(lock_path, 'a')
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.lock_file.close()
+                raise RuntimeError(f'{camera_dir} is locked while its household is being moved') from None
+        self.camera_dir = camera_dir
+        self.source = source
+        self.fps = source.fps
+        os.makedirs(os.path.join(camera_dir, 'segments'), exist_ok=True)
+        self.ring = RingBuffer(os.path.join(camera_dir, 'ring.buf'),
+                               slot_count=max(1, int(ring_seconds * self.fps)),
+                               slot_size=source.width * source.height,
+                               width=source.width, height=source.height)
+        self.pre_roll = int(pre_roll_seconds * self.fps)
+        self.post_roll = int(post_roll_seconds * self.fps)
+        self.segment_seconds = segment_seconds
+
+        self.mode = 'idle'
+        self.clip = None
+        self.quiet_frames = 0
+        self.previous = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.frames = 0
+        self.cpu_seconds = 0.0
+        self.started_at = None
+
+    def start(self):
+        if self.thread is None:
+            self.started_at = time.time()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def set_mode(self, mode):
+        with self.lock:
+            if mode != self.mode:
+                self._close_clip()
+                self.mode = mode
+
+    def capture(self):
+        """Read one frame from the source into the ring; returns ``(timestamp, frame)``."""
+        timestamp, frame = self.source.read()
+        self.ring.write(timestamp, frame)
+        self.frames += 1
+        return timestamp, frame
+
+    def snapshot(self):
+        """Persist the newest frame as a single-frame segment.
+
+        Only a running capture loop keeps the ring current. The ring file
+        outlives recorders and may be hours old, so unless the loop has
+        already written a frame of its own, a fresh one is captured.
+        """
+        latest = self.ring.latest() if self.thread else None
+        if latest is None or latest[0] < self.started_at:
+            latest = self.capture()
+        writer = SegmentWriter(self.camera_dir, 'snapshot', self.source.width, self.source.height)
+        writer.write(*latest)
+        return writer.close()
+
+    def _run(self):
+        interval = 1.0 / self.fps
+        next_tick = time.monotonic()
+        while not self.stop_event.is_set():
+            cpu_start = time.thread_time()
+            timestamp, frame = self.capture()
+            with self.lock:
+                self._process(timestamp, frame)
+            self.cpu_seconds += time.thread_time() - cpu_start
+
+            next_tick += interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            else:
+                next_tick = time.monotonic()  # Fell behind; don't try to catch up
+        with self.lock:
+            self._close_clip()
+
+    def _process(self, timestamp, frame):
+        if self.mode == 'record':
+            if self.clip and timestamp - self.clip.started_at >= self.segment_seconds:
+                self._close_clip()
+            if not self.clip:
+                self.clip = SegmentWriter(self.camera_dir, 'recording', self.source.width, self.source.height)
+            self.clip.write(timestamp, frame)
+        elif self.mode == 'motion':
+            if self._detect_motion(frame):
+                self.quiet_frames = 0
+                if not self.clip:
+                    self.clip = SegmentWriter(self.camera_dir, 'motion', self.source.width, self.source.height)
+                    # Pre-roll from the ring, which already holds the current frame
+                    for buffered in self.ring.recent(self.pre_roll + 1):
+                        self.clip.write(*buffered)
+                    return
+            elif self.clip:
+                self.quiet_frames += 1
+                if self.quiet_frames > self.post_roll:
+                    self._close_clip()
+                    return
+            if self.clip:
+                self.clip.write(timestamp, frame)
+
+    def _detect_motion(self, frame):
+        # Compare every 4th pixel in each direction; plenty for coarse motion
+        pixels = np.frombuffer(frame, dtype=np.uint8).reshape(self.source.height, self.source.width)[::4, ::4]
+        previous, self.previous = self.previous, pixels.astype(np.int16)
+        if previous is None:
+            return False
+        return float(np.abs(self.previous - previous).mean()) > MOTION_THRESHOLD
+
+    def _close_clip(self):
+        if self.clip:
+            self.clip.close()
+            self.clip = None
+            self.quiet_frames = 0
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        else:
+            with self.lock:
+                self._close_clip()
+        self.ring.close()
+        self.source.close()
+        if self.lock_file:
+            self.lock_file.close()  # Releases the flock
+
+    def stats(self):
+        elapsed = max(time.time() - self.started_at, 1e-9) if self.started_at else 0.0
+        return {
+            'mode': self.mode,
+            'frames': self.frames,
+            'fps': round(self.frames / elapsed, 2) if elapsed else 0.0,
+            'cpu_percent': round(100 * self.cpu_seconds / elapsed, 2) if elapsed else 0.0,
+            'ring_bytes': os.path.getsize(self.ring.path)
+        }
+
+
+def camera_key(user_id, device_id):
+    """Media key for a camera; device ids are only unique within a household shard."""
+    return f'{user_id}/{device_id}'
+
+
+class CameraManager:
+    """Owns the recorders of every camera device in the process."""
+
+    # Device states from handle_camera mapped to recorder modes
+    STATE_MODES = {
+        'recording': 'record',
+        'motion_detection': 'motion'
+    }
+
+    def __init__(self, root, source='synthetic', **source_options):
+        self.root = root
+        self.source_factory = FRAME_SOURCES[source]
+        self.source_options = source_options
+        self.recorders = {}
+        self.lock = threading.Lock()
+
+    def camera_dir(self, camera_id):
+        return os.path.join(self.root, str(camera_id))
+
+    def household_lock_path(self, household):
+        # Beside the household directory, so it survives rekey_household renaming that
+        return os.path.join(self.root, f'{household}.lock')
+
+    def _new_recorder(self, camera_id):
+        household, _, device = str(camera_id).partition('/')
+        lock_path = None
+        if device:  # A camera_key(); plain ids have no household to lock
+            os.makedirs(self.root, exist_ok=True)
+            lock_path = self.household_lock_path(household)
+        return CameraRecorder(self.camera_dir(camera_id), self.source_factory(**self.source_options),
+                              lock_path=lock_path)
+
+    def recorder(self, camera_id):
+        with self.lock:
+            if camera_id not in self.recorders:
+                self.recorders[camera_id] = self._new_recorder(camera_id)
+            return self.recorders[camera_id]
+
+    def snapshot(self, camera_id):
+        """Snapshot from the camera's running recorder, or from a one-off recorder.
+
+        The one-off recorder is closed again right away, so a snapshot of an
+        idle camera leaves no open ring or source behind.
+        """
+        with self.lock:
+            recorder = self.recorders.get(camera_id)
+            if recorder is None:
+                recorder = self._new_recorder(camera_id)
+                try:
+                    return recorder.snapshot()
+                finally:
+                    recorder.stop()
+        return recorder.snapshot()
+
+    def apply_state(self, camera_id, state):
+        """Start, reconfigure or stop a camera's capture to match its device state."""
+        if state == 'snapshot':
+            return self.snapshot(camera_id)
+        mode = self.STATE_MODES.get(state)
+        if mode is None:
+            self.stop(camera_id)
+            return None
+        recorder = self.recorder(camera_id)
+        recorder.set_mode(mode)
+        recorder.start()
+        return None
+
+    def stop(self, camera_id):
+        with self.lock:
+            recorder = self.recorders.pop(camera_id, None)
+        if recorder:
+            recorder.stop()
+
+    def stop_all(self):
+        for camera_id in list(self.recorders):
+            self.stop(camera_id)
+
+    def segments(self, camera_id):
+        """Index entries for a camera, oldest first."""
+        path = os.path.join(self.camera_dir(camera_id), 'index.ndjson')
+        if not os.path.exists(path):
+            return []
+        with open(path) as index:
+            return [json.loads(line) for line in index if line.strip()]
+
+    def segment_path(self, camera_id, segment_id):
+        """Path of a segment file, or None if it isn't in the camera's index."""
+        if not any(entry['id'] == segment_id for entry in self.segments(camera_id)):
+            return None
+        return os.path.join(self.camera_dir(camera_id), 'segments', f'{segment_id}.seg')
+
+    def rename(self, camera_id, new_camera_id):
+        """Move a stopped camera's media to a new key that has none yet."""
+        old_dir = self.camera_dir(camera_id)
+        new_dir = self.camera_dir(new_camera_id)
+        if os.path.isdir(old_dir) and not os.path.exists(new_dir):
+            os.makedirs(os.path.dirname(new_dir), exist_ok=True)
+            os.rename(old_dir, new_dir)
+
+    @contextlib.contextmanager
+    def lock_household(self, user_id):
+        """Keep a household's media still for the duration of the block.
+
+        Every recorder of the household holds a shared lock on the household's
+        lock file, in whichever process it runs. Taking it exclusively raises
+        RuntimeError while any of them is running, and keeps new ones (and
+        snapshots) from starting until the block exits.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.household_lock_path(user_id), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f'Household {user_id} has cameras recording; stop them first') from None
+            yield
+
+    def rekey_household(self, user_id, id_map):
+        """Rename a household's camera directories after its device ids changed.
+
+        Call it inside ``lock_household``. Nothing happens when no id changed.
+        Directories go through a staging directory, so renames that overlap
+        (old id of one camera equal to the new id of another) cannot collide.
+        Media of devices missing from ``id_map`` is kept, moved aside to
+        ``<user_id>.unmapped-<timestamp>``.
+        """
+        household = os.path.join(self.root, str(user_id))
+        if not os.path.isdir(household) or all(old_id == new_id for old_id, new_id in id_map.items()):
+            return
+        staging = household + '.rekey'
+        os.rename(household, staging)
+        os.makedirs(household)
+        for old_id, new_id in id_map.items():
+            old_dir = os.path.join(staging, str(old_id))
+            if os.path.isdir(old_dir):
+                os.rename(old_dir, os.path.join(household, str(new_id)))
+        if os.listdir(staging):
+            os.rename(staging, f'{household}.unmapped-{int(time.time())}')
+        else:
+            os.rmdir(staging)
+
+    def stats(self):
+        with self.lock:
+            recorders = dict(self.recorders)
+        return {camera_id: recorder.stats() for camera_id, recorder in recorders.items()}
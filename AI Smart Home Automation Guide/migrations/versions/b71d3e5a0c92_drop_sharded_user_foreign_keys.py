@@ -0,0 +1,43 @@
+"""drop user foreign keys from sharded tables
+
+Revision ID: b71d3e5a0c92
+Revises: 9e4b1c7f2a80
+Create Date: 2026-10-19 18:12:40.507116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71d3e5a0c92'
+down_revision = '9e4b1c7f2a80'
+branch_labels = None
+depends_on = None
+
+# Device, rule and event rows may live in a shard database without a user table
+SHARDED_TABLES = ['device', 'automation_rule', 'device_state_event']
+
+# SQLite reflects these constraints without a name; batch mode names them by this convention
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+
+def user_foreign_key(table):
+    for foreign_key in sa.inspect(op.get_bind()).get_foreign_keys(table):
+        if foreign_key['referred_table'] == 'user':
+            return foreign_key['name'] or f'fk_{table}_user_id_user'
+    return None
+
+
+def upgrade():
+    for table in SHARDED_TABLES:
+        name = user_foreign_key(table)
+        if name:
+            with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+                batch_op.drop_constraint(name, type_='foreignkey')
+
+
+def downgrade():
+    for table in SHARDED_TABLES:
+        with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+            batch_op.create_foreign_key(f'fk_{table}_user_id_user', 'user', ['user_id'], ['id'])
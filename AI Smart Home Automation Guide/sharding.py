@@ -0,0 +1,417 @@
+"""Household sharding for the per-household tables.
+
+User accounts and the ``household_shard`` placement directory stay in the
+main database. Devices, automation rules and device state events, which are
+the tables marked ``info={'sharded': True}``, live in one of several shard
+databases, chosen per household.
+
+Shards are configured with ``HOUSEHOLD_SHARDS``, given either as a dict in
+``app.config`` or as ``name=url,name=url`` in the environment. Any SQLAlchemy
+URL works, so a shard can be a SQLite file or a server database. A shard
+whose URL is ``default`` (or the main database URI) shares the main engine.
+Each other shard is registered as a Flask-SQLAlchemy bind, so it gets its
+own engine and connection pool. The ``default`` shard, where households live
+before any shards are configured, always maps to the main engine. A list
+that leaves it out only takes it off the ring, so households still placed
+there keep working until ``rebalance`` moves them. Do not point ``default``
+at another database.
+
+Only the sharded tables exist on a separate shard database, so their
+``user_id`` columns carry no foreign key to ``user``; keys between sharded
+tables (events and rules to devices) are kept. Alembic (``flask db
+upgrade``) migrates the main database only. A shard database gets its
+tables from ``db.create_all()``, which every command below runs first, but
+``create_all`` never alters a table that already exists. A migration that
+changes a sharded table therefore has to be applied to every shard database
+as well, for example by running the same operations against each
+``db.shard_engine(name)``.
+
+New households are placed on the owner of ``user_id`` in a consistent hash
+ring, and the placement is recorded in the directory. Requests call
+``app.use_household(user_id)``, which stores the shard name in
+``db.session.info``. ``HouseholdSession.get_bind`` then sends every
+statement that touches a sharded table to that shard's engine.
+
+Command line, run from the project directory::
+
+    python sharding.py status      # households per shard
+    python sharding.py pin         # record placements for older households
+    python sharding.py rebalance   # move households to their ring owner
+
+Run ``pin`` before changing the shard list, so that households created
+before placements were recorded are not lost track of. After the list
+changes, ``rebalance`` moves each household whose ring owner changed, one
+at a time. Households with a camera recording on this host are skipped;
+stop their cameras and run it again.
+"""
+import argparse
+import bisect
+import hashlib
+from datetime import datetime, timedelta
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.util import find_tables
+
+DEFAULT_SHARD = 'default'
+RING_REPLICAS = 64
+
+# Rows per batch when a household is copied between shards
+MOVE_BATCH_SIZE = 1000
+# Events older than this are copied before the source is locked; newer ones may still be committing
+MOVE_SETTLE_TIME = timedelta(minutes=1)
+
+
+class HashRing:
+    """Consistent hash ring; adding a shard only moves ~1/N of the keys."""
+
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        points = sorted(
+            (self._hash(f'{shard}#{i}'), shard) for shard in shards for i in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key):
+        index = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.shards[index]
+
+
+def parse_shards(value, default_uri):
+    """Normalise ``HOUSEHOLD_SHARDS`` into ``{name: uri or None}``; None means the main engine."""
+    if not value:
+        return {DEFAULT_SHARD: None}
+    if isinstance(value, str):
+        value = dict(item.split('=', 1) for item in value.split(',') if item.strip())
+    return {
+        name.strip(): None if uri in (None, DEFAULT_SHARD, default_uri) else uri.strip()
+        for name, uri in value.items()
+    }
+
+
+def sharded_table(mapper, clause):
+    """The sharded table a statement targets, if any."""
+    if mapper is not None:
+        table = mapper.persist_selectable
+        return table if table.info.get('sharded') else None
+    if clause is not None:
+        for table in find_tables(clause, include_crud=True):
+            if table.info.get('sharded'):
+                return table
+    return None
+
+
+class HouseholdSession(SignallingSession):
+    """Session that routes sharded tables to the household selected in ``info['shard']``."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if sharded_table(mapper, clause) is not None:
+            db = get_state(self.app).db
+            if db.is_sharded:
+                shard = self.info.get('shard')
+                if shard is None:
+                    raise RuntimeError('No household shard selected; call use_household(user_id) first')
+                return db.shard_engine(shard)
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with one bind (engine and pool) per household shard."""
+
+    def init_app(self, app):
+        self.shards = parse_shards(app.config.get('HOUSEHOLD_SHARDS'), app.config.get('SQLALCHEMY_DATABASE_URI'))
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for name, uri in self.shards.items():
+            if uri is not None:
+                binds[self.bind_key(name)] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        self.ring = HashRing(self.shards)
+        # Off the ring, but still reachable for households placed there earlier
+        self.shards.setdefault(DEFAULT_SHARD, None)
+        super().init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=HouseholdSession, db=self, **options)
+
+    @property
+    def is_sharded(self):
+        return any(uri is not None for uri in self.shards.values())
+
+    def distinct_shards(self):
+        """One shard name per database, for reads that must see every row exactly once."""
+        first = {}
+        for shard, uri in self.shards.items():
+            first.setdefault(uri, shard)
+        return list(first.values())
+
+    @staticmethod
+    def bind_key(shard):
+        return f'shard:{shard}'
+
+    def shard_engine(self, shard, app=None):
+        if shard not in self.shards:
+            raise KeyError(f'Unknown household shard {shard!r}; check HOUSEHOLD_SHARDS')
+        if self.shards[shard] is None:
+            return self.get_engine(app)
+        return self.get_engine(app, bind=self.bind_key(shard))
+
+    def sharded_tables(self):
+        return [table for table in self.Model.metadata.sorted_tables if table.info.get('sharded')]
+
+    def create_all(self, bind='__all__', app=None):
+        super().create_all(bind, app)
+        # Shard binds own no tables by bind_key, so create the sharded tables on each explicitly
+        if bind == '__all__':
+            for shard, uri in self.shards.items():
+                if uri is not None:
+                    self.Model.metadata.create_all(bind=self.shard_engine(shard, app), tables=self.sharded_tables())
+
+    def drop_all(self, bind='__all__', app=None):
+        if bind == '__all__':
+            for shard, uri in self.shards.items():
+                if uri is not None:
+                    self.Model.metadata.drop_all(bind=self.shard_engine(shard, app), tables=self.sharded_tables())
+        super().drop_all(bind, app)
+
+
+def set_placement(connection, placement_model, user_id, shard):
+    """Record a household's shard in the directory."""
+    table = placement_model.__table__
+    updated = connection.execute(table.update().where(table.c.user_id == user_id).values(shard=shard))
+    if not updated.rowcount:
+        connection.execute(table.insert().values(user_id=user_id, shard=shard))
+
+
+def copy_rows(connection, table, rows, id_map):
+    """Insert copies of event rows with new ids, remapping ``device_id`` through ``id_map``."""
+    copies = []
+    for row in rows:
+        values = dict(row._mapping)
+        values.pop('id')
+        values['device_id'] = id_map.get(values['device_id'])
+        if values['device_id'] is not None:  # Skip history of deleted devices
+            copies.append(values)
+    if copies:
+        connection.execute(table.insert(), copies)
+
+
+def household_batches(engine, table, user_id, clause, batch_size):
+    """Yield a household's rows matching ``clause`` in id order, one short read per batch."""
+    last_id = 0
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                table.select().where(table.c.user_id == user_id).where(clause).where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)
+            ).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+def move_household(db, user_id, source, target, batch_size=MOVE_BATCH_SIZE):
+    """Copy one household from ``source`` to ``target`` and delete the original.
+
+    Primary keys are reassigned on the target, because ids are only unique
+    within a shard. Foreign keys between the household's rows are remapped.
+    The move runs in two steps:
+
+    1. Without locking the source, the devices and all events older than
+       ``MOVE_SETTLE_TIME`` are copied in ``batch_size`` batches, each in
+       its own target transaction.
+    2. A no-op update of the household's devices write-locks the source, so
+       concurrent commands for the household wait. Device rows are synced,
+       so devices added, changed or deleted since step 1 are caught up. Then
+       the rules and newer events are copied, the source rows are deleted,
+       the placement is flipped and the source transaction commits.
+
+    Step 2 holds the lock while it copies a few rows and deletes the
+    household's rows from the source. The delete scales with the event
+    history, but costs far less than copying it (about 0.6s for 200k
+    events on SQLite). On SQLite the lock covers the whole shard database,
+    so other households on the source wait for step 2 as well.
+
+    A command for the household that loaded a device before step 2 and
+    commits after it fails with ``StaleDataError``, because the source row
+    is gone; sent again, it is routed to the target. If either step fails,
+    the partial copy is removed and the household stays on the source. When
+    the directory lives apart from the source and the source commit fails
+    after the flip, the placement is put back before the copy is removed; if
+    that fails too, the household stays on the complete copy on the target.
+    ``analytics.load_intervals`` follows the placement, so the copy is not
+    counted while it is in progress.
+
+    Returns ``{old_device_id: new_device_id}``.
+    """
+    from app import Device, AutomationRule, DeviceStateEvent, HouseholdShard
+
+    device_table = Device.__table__
+    rule_table = AutomationRule.__table__
+    event_table = DeviceStateEvent.__table__
+
+    with db.get_engine().connect() as directory:
+        table = HouseholdShard.__table__
+        placed = directory.execute(table.select().where(table.c.user_id == user_id)).first()
+    if (placed.shard if placed else db.ring.owner(user_id)) != source:
+        raise ValueError(f'Household {user_id} is not on shard {source!r}')
+
+    if db.shards[source] == db.shards[target]:
+        # Both names point at the same database; only the placement changes
+        with db.get_engine().begin() as directory:
+            set_placement(directory, HouseholdShard, user_id, target)
+        return {}
+
+    src_engine = db.shard_engine(source)
+    dst_engine = db.shard_engine(target)
+
+    def clear_target():
+        # The household is placed on the source, so any rows on the target are a partial copy
+        with dst_engine.begin() as dst:
+            for table in (event_table, rule_table, device_table):
+                dst.execute(table.delete().where(table.c.user_id == user_id))
+
+    clear_target()
+    cutoff = datetime.utcnow() - MOVE_SETTLE_TIME
+    # Whether the directory, committed apart from the source, points at the target
+    flipped = False
+    try:
+        # Step 1: devices and settled history, without the source lock
+        id_map = {}
+        with src_engine.connect() as src:
+            devices = src.execute(device_table.select().where(device_table.c.user_id == user_id)).fetchall()
+        with dst_engine.begin() as dst:
+            for row in devices:
+                values = dict(row._mapping)
+                old_id = values.pop('id')
+                id_map[old_id] = dst.execute(device_table.insert().values(**values)).inserted_primary_key[0]
+        for rows in household_batches(src_engine, event_table, user_id, event_table.c.changed_at < cutoff,
+                                      batch_size):
+            with dst_engine.begin() as dst:
+                copy_rows(dst, event_table, rows, id_map)
+
+        # Step 2: catch up under the source lock and flip the placement
+        with src_engine.connect() as src:
+            src_tx = src.begin()
+            try:
+                src.execute(device_table.update().where(device_table.c.user_id == user_id)
+                            .values(state=device_table.c.state))
+                with dst_engine.begin() as dst:
+                    current = {row.id: row for row in
+                               src.execute(device_table.select().where(device_table.c.user_id == user_id))}
+                    for old_id in set(id_map) - set(current):
+                        new_id = id_map.pop(old_id)
+                        dst.execute(event_table.delete().where(event_table.c.device_id == new_id))
+                        dst.execute(device_table.delete().where(device_table.c.id == new_id))
+                    for old_id, row in current.items():
+                        values = dict(row._mapping)
+                        values.pop('id')
+                        if old_id in id_map:
+                            dst.execute(device_table.update().where(device_table.c.id == id_map[old_id])
+                                        .values(**values))
+                        else:
+                            result = dst.execute(device_table.insert().values(**values))
+                            id_map[old_id] = result.inserted_primary_key[0]
+
+                    rules = []
+                    for row in src.execute(rule_table.select().where(rule_table.c.user_id == user_id)):
+                        values = dict(row._mapping)
+                        values.pop('id')
+                        for column in ('trigger_device_id', 'action_device_id'):
+                            if values[column] is not None:
+                                values[column] = id_map.get(values[column])
+                        rules.append(values)
+                    if rules:
+                        dst.execute(rule_table.insert(), rules)
+
+                    recent = src.execute(event_table.select().where(event_table.c.user_id == user_id)
+                                         .where(event_table.c.changed_at >= cutoff).order_by(event_table.c.id))
+                    while True:
+                        chunk = recent.fetchmany(batch_size)
+                        if not chunk:
+                            break
+                        copy_rows(dst, event_table, chunk, id_map)
+
+                for table in (event_table, rule_table, device_table):
+                    src.execute(table.delete().where(table.c.user_id == user_id))
+                # Flip the placement only once the copy is durable on the target. When
+                # the source is the main database it already holds the write lock there.
+                if db.shards[source] is None:
+                    set_placement(src, HouseholdShard, user_id, target)
+                else:
+                    with db.get_engine().begin() as directory:
+                        set_placement(directory, HouseholdShard, user_id, target)
+                    flipped = True
+                src_tx.commit()
+            except Exception:
+                src_tx.rollback()
+                if flipped:
+                    # The source rows are back, so point the directory at them again
+                    with db.get_engine().begin() as directory:
+                        set_placement(directory, HouseholdShard, user_id, source)
+                    flipped = False
+                raise
+    except Exception:
+        if not flipped:
+            clear_target()
+        raise
+    return id_map
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and rebalance household shards.')
+    parser.add_argument('command', choices=['status', 'pin', 'rebalance'])
+    parser.add_argument('--dry-run', action='store_true', help='list the moves rebalance would make')
+    args = parser.parse_args(argv)
+
+    from app import app, db, User, HouseholdShard, camera_media
+
+    with app.app_context():
+        db.create_all()
+        placements = dict(db.session.query(HouseholdShard.user_id, HouseholdShard.shard))
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+        current = {user_id: placements.get(user_id) or db.ring.owner(user_id) for user_id in user_ids}
+
+        if args.command == 'status':
+            for shard in db.shards:
+                on_shard = sum(1 for placed in current.values() if placed == shard)
+                misplaced = sum(1 for user_id, placed in current.items()
+                                if placed == shard and db.ring.owner(user_id) != shard)
+                print(f'{shard}: {on_shard} households ({misplaced} to move)')
+
+        elif args.command == 'pin':
+            missing = [user_id for user_id in user_ids if user_id not in placements]
+            # An executemany with no rows would run a single INSERT of the column defaults
+            if missing:
+                db.session.execute(HouseholdShard.__table__.insert(),
+                                   [{'user_id': user_id, 'shard': current[user_id]} for user_id in missing])
+                db.session.commit()
+            print(f'Pinned {len(missing)} households')
+
+        else:
+            moves = [(user_id, placed, db.ring.owner(user_id)) for user_id, placed in current.items()
+                     if placed != db.ring.owner(user_id)]
+            skipped = 0
+            for user_id, source, target in moves:
+                print(f'household {user_id}: {source} -> {target}')
+                if not args.dry_run:
+                    try:
+                        # Camera media is keyed by device id, which changes with the move
+                        with camera_media.lock_household(user_id):
+                            id_map = move_household(db, user_id, source, target)
+                            camera_media.rekey_household(user_id, id_map)
+                    except RuntimeError as e:
+                        print(f'  skipped: {e}')
+                        skipped += 1
+            if args.dry_run:
+                print(f'{len(moves)} households to move')
+            else:
+                print(f'{len(moves) - skipped} households moved, {skipped} skipped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+"""Home simulation harness for load-testing the chat command path.
+
+Creates N synthetic households with the same default devices as
+``/register``, then replays a simulated day in compressed time. Occupancy
+(who is home and awake), indoor temperature drift and HVAC response are
+stepped for every home at once with NumPy. Each tick turns into chat
+commands such as arrivals, departures, comfort adjustments and random
+device use. Commands go through the real ``process_command`` path (intent
+recognition, handler, commit), either in-process or as ``POST /chat``
+requests to a running server.
+
+Examples, from the project directory::
+
+    python simulator.py --homes 1000
+    python simulator.py --homes 10000 --processes 8 --database sqlite:////tmp/sim.db
+    python simulator.py --homes 200 --http http://127.0.0.1:5000 --database sqlite:////path/to/smart_home.db
+
+In HTTP mode, ``--database`` must point at the server's database, because
+households are provisioned there directly before the run.
+"""
+import argparse
+import http.cookiejar
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+SIM_PASSWORD = 'simulated'
+# Synthetic accounts only need a cheap hash; the default cost would dominate HTTP logins
+SIM_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+DAY_SECONDS = 24 * 3600
+
+# Chance per hour that occupants are home, and awake, on a working day
+HOME_BY_HOUR = np.array([.98, .98, .98, .98, .98, .97, .95, .80, .45, .25, .20, .20,
+                         .22, .20, .20, .22, .30, .55, .80, .90, .95, .97, .98, .98])
+AWAKE_BY_HOUR = np.array([.03, .02, .02, .02, .03, .10, .45, .85, .90, .90, .90, .90,
+                          .90, .90, .90, .90, .90, .90, .90, .90, .85, .65, .35, .10])
+
+# Commands an occupant at home might issue, with relative weights. Camera
+# commands are left out so load runs don't start media recorders.
+ROUTINE_COMMANDS = [
+    ('Turn on the lights', 3),
+    ('Turn off the lights', 3),
+    ('Set brightness to {percent}%', 2),
+    ('Change lights to {color}', 1),
+    ('Play music on the speaker', 2),
+    ('Pause music on the speaker', 1),
+    ('Set speaker volume to {percent}', 1),
+    ('Turn on the fan', 1),
+    ('Set fan to high', 1),
+    ('Turn off the fan', 1),
+    ('Open the blinds', 2),
+    ('Close the blinds', 2),
+    ('Turn on the outlet', 1),
+    ('Turn off the outlet', 1),
+    ('What is the temperature?', 1)
+]
+COLORS = ['red', 'blue', 'green', 'yellow', 'purple', 'white']
+
+
+class HomePhysics:
+    """Vectorized occupancy and thermal state of every simulated home."""
+
+    def __init__(self, homes, rng, step_seconds):
+        self.rng = rng
+        self.step_hours = step_seconds / 3600
+        self.home = rng.random(homes) < HOME_BY_HOUR[0]
+        self.indoor = rng.normal(70.0, 1.5, homes)
+        self.setpoint = np.full(homes, 72.0)
+        self.preferred = rng.normal(71.0, 2.0, homes)
+        # Hours for the indoor temperature to close ~63% of the gap to outdoors
+        self.time_constant = rng.uniform(4.0, 10.0, homes)
+        self.hvac_rate = rng.uniform(2.0, 5.0, homes)  # °F per hour at full output
+
+    def outdoor(self, hour):
+        return 55.0 + 15.0 * np.sin((hour - 9.0) / 24.0 * 2 * np.pi)
+
+    def step(self, hour, command_rate):
+        """Advance one tick and return boolean masks of homes that act."""
+        slot = int(hour) % 24
+        was_home = self.home
+        # Sticky occupancy: only a fraction of homes re-roll each tick
+        reroll = self.rng.random(self.home.size) < 0.15
+        self.home = np.where(reroll, self.rng.random(self.home.size) < HOME_BY_HOUR[slot], was_home)
+        awake = self.home & (self.rng.random(self.home.size) < AWAKE_BY_HOUR[slot])
+
+        # Newtonian drift toward outdoors plus HVAC pushing toward the setpoint
+        drift = (self.outdoor(hour) - self.indoor) / self.time_constant
+        hvac = np.clip(self.setpoint - self.indoor, -1.0, 1.0) * self.hvac_rate
+        self.indoor += (drift + hvac) * self.step_hours
+
+        # Preferences are a little cooler at night
+        comfort = self.preferred - np.where((slot >= 22) | (slot < 6), 3.0, 0.0)
+        adjust = awake & (np.abs(self.indoor - comfort) > 2.5) & (np.abs(self.setpoint - comfort) > 1.0)
+        self.setpoint = np.where(adjust, np.round(comfort), self.setpoint)
+
+        return {
+            'arrived': self.home & ~was_home,
+            'left': was_home & ~self.home,
+            'adjust': adjust,
+            'routine': awake & (self.rng.random(self.home.size) < command_rate * self.step_hours)
+        }
+
+
+def day_events(homes, step_seconds, commands_per_hour, seed):
+    """Yield ``(tick, [(home_index, message), ...])`` for one simulated day."""
+    rng = np.random.default_rng(seed)
+    physics = HomePhysics(homes, rng, step_seconds)
+    templates = [template for template, _ in ROUTINE_COMMANDS]
+    weights = np.array([weight for _, weight in ROUTINE_COMMANDS], dtype=float)
+    weights /= weights.sum()
+
+    for tick in range(int(DAY_SECONDS / step_seconds)):
+        hour = tick * step_seconds / 3600
+        masks = physics.step(hour, commands_per_hour)
+        events = []
+        for i in np.flatnonzero(masks['arrived']):
+            events.append((i, 'Unlock the front door'))
+            events.append((i, 'Turn on the lights'))
+        for i in np.flatnonzero(masks['left']):
+            events.append((i, 'Lock the front door'))
+            events.append((i, 'Turn off the lights'))
+        for i in np.flatnonzero(masks['adjust']):
+            events.append((i, f'Set temperature to {int(physics.setpoint[i])}'))
+        routine = np.flatnonzero(masks['routine'])
+        picks = rng.choice(len(templates), size=routine.size, p=weights)
+        percents = rng.integers(10, 101, routine.size)
+        colors = rng.integers(0, len(COLORS), routine.size)
+        for i, pick, percent, color in zip(routine, picks, percents, colors):
+            events.append((i, templates[pick].format(percent=percent, color=COLORS[color])))
+        yield tick, events
+
+
+def provision_homes(homes, run_id):
+    """Bulk-create households, their shard placements and default devices; returns user ids."""
+    from werkzeug.security import generate_password_hash
+    from app import app, db, User, Device, HouseholdShard, DEFAULT_DEVICES, bulk_insert, record_initial_states
+
+    password_hash = generate_password_hash(SIM_PASSWORD, method=SIM_HASH_METHOD)
+    prefix = f'sim-{run_id}-'
+    with app.app_context():
+        db.create_all()
+        bulk_insert(User.__table__, ({'username': f'{prefix}{i}', 'password_hash': password_hash}
+                                     for i in range(homes)))
+        rows = db.session.query(User.id, User.username).filter(User.username.like(f'{prefix}%')).all()
+        user_ids = [user_id for user_id, _ in sorted(rows, key=lambda row: int(row[1][len(prefix):]))]
+
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(db.ring.owner(user_id), []).append(user_id)
+        bulk_insert(HouseholdShard.__table__, ({'user_id': user_id, 'shard': shard}
+                                               for shard, members in by_shard.items() for user_id in members))
+        for shard, members in by_shard.items():
+            db.session.info['shard'] = shard
+            bulk_insert(Device.__table__, ({'name': name, 'type': device_type, 'state': state, 'user_id': user_id}
+                                           for user_id in members
+                                           for name, device_type, state in DEFAULT_DEVICES))
+            record_initial_states(members)
+        db.session.commit()
+    return [f'{prefix}{i}' for i in range(homes)], user_ids
+
+
+class InProcessDriver:
+    """Runs commands through ``process_command`` on worker threads.
+
+    SQLite's default busy timeout waits up to 5s for a write lock inside the
+    driver, which hides contention. SQLite engines are therefore switched to
+    a ``lock_timeout`` (seconds) busy timeout, and every attempt that still
+    fails on a lock is rolled back, counted and retried, with the time it
+    spent waiting added to the lock-wait total.
+    """
+
+    def __init__(self, retries=100, lock_timeout=0.05):
+        from app import app, db, process_command
+        from sqlalchemy import event
+        from sqlalchemy.exc import OperationalError
+
+        self.app = app
+        self.db = db
+        self.process_command = process_command
+        self.operational_error = OperationalError
+        self.retries = retries
+        self.local = threading.local()
+
+        def set_busy_timeout(dbapi_connection, connection_record):
+            dbapi_connection.execute(f'PRAGMA busy_timeout = {int(lock_timeout * 1000)}')
+
+        with app.app_context():
+            engines = {db.get_engine()} | {db.shard_engine(shard) for shard in db.shards}
+        for engine in engines:
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', set_busy_timeout)
+                engine.dispose()  # Pooled connections still have the old timeout
+
+    def send(self, user_id, username, message):
+        """Returns ``(ok, lock_retries, lock_wait_seconds)``."""
+        if not hasattr(self.local, 'context'):
+            # One app context per worker thread gives each its own scoped session
+            self.local.context = self.app.app_context()
+            self.local.context.push()
+        waited = 0.0
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                self.process_command(message, user_id)
+                if self.db.session.is_active:
+                    return True, attempt, waited
+                # A handler's bare except swallowed a failed commit; treat it like a lock error
+            except self.operational_error:
+                pass
+            except Exception:
+                self.db.session.rollback()
+                return False, attempt, waited
+            self.db.session.rollback()
+            waited += time.perf_counter() - started
+        return False, self.retries, waited
+
+
+class HttpDriver:
+    """Posts commands to ``/chat`` on a running server, one cookie session per home.
+
+    Redirects are not followed, so a rejected login or a ``/chat`` bounced to
+    the login page shows up as an error instead of a page that reads as a
+    success. Lock contention happens inside the server and is not measured.
+    """
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            return None  # urllib then raises HTTPError for the 3xx
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.openers = {}
+        self.lock = threading.Lock()
+
+    def login(self, username):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                             self.NoRedirect())
+        form = urllib.parse.urlencode({'username': username, 'password': SIM_PASSWORD}).encode()
+        try:
+            opener.open(f'{self.base_url}/login', form).read()
+        except urllib.error.HTTPError as e:
+            # Success redirects to the home page; a failed login re-renders the form with 200
+            if e.code == 302 and not urllib.parse.urlparse(e.headers.get('Location', '')).path.endswith('/login'):
+                return opener
+            raise
+        raise RuntimeError(f'Login failed for {username}')
+
+    def opener(self, username):
+        with self.lock:
+            opener = self.openers.get(username)
+        if opener is None:
+            opener = self.login(username)
+            with self.lock:
+                self.openers[username] = opener
+        return opener
+
+    def send(self, user_id, username, message):
+        body = json.dumps({'message': message}).encode()
+        request = urllib.request.Request(f'{self.base_url}/chat', body, {'Content-Type': 'application/json'})
+        try:
+            with self.opener(username).open(request) as response:
+                ok = response.status == 200 and 'response' in json.loads(response.read())
+            return ok, 0, 0.0
+        except (OSError, RuntimeError, ValueError):
+            return False, 0, 0.0
+
+
+def run_slice(http_url, usernames, user_ids, workers, step, rate, seed):
+    """Simulate a day for a slice of homes; returns ``(latencies, intents, totals)``.
+
+    Module-level so it can run in a spawned worker process.
+    """
+    from app import recognize_intent
+
+    driver = HttpDriver(http_url) if http_url else InProcessDriver()
+    latencies = []
+    intents = Counter()
+    totals = Counter()
+    lock = threading.Lock()
+
+    def dispatch(home, message):
+        start = time.perf_counter()
+        ok, retries, waited = driver.send(user_ids[home], usernames[home], message)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            intents[recognize_intent(message)] += 1
+            totals['events'] += 1
+            totals['lock_retries'] += retries
+            totals['lock_wait'] += waited
+            totals['failed'] += not ok
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for tick, events in day_events(len(user_ids), step, rate, seed):
+            # Ticks are barriers: a tick's events all finish before the next begins
+            list(pool.map(lambda event: dispatch(*event), events))
+    return np.array(latencies), intents, totals
+
+
+def run(usernames, user_ids, args):
+    """Split homes across ``args.processes`` processes and merge their results."""
+    slices = np.array_split(np.arange(len(user_ids)), args.processes)
+    jobs = [(args.http, [usernames[i] for i in part], [user_ids[i] for i in part],
+             args.workers, args.step, args.rate, args.seed + n)
+            for n, part in enumerate(slices) if part.size]
+
+    started = time.perf_counter()
+    if len(jobs) == 1:
+        results = [run_slice(*jobs[0])]
+    else:
+        # Spawn rather than fork so no process inherits the parent's DB connections
+        with ProcessPoolExecutor(len(jobs), mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(run_slice, *zip(*jobs)))
+    wall = time.perf_counter() - started
+
+    intents = Counter()
+    totals = Counter()
+    for _, slice_intents, slice_totals in results:
+        intents.update(slice_intents)
+        totals.update(slice_totals)
+    latencies = np.concatenate([slice_latencies for slice_latencies, _, _ in results])
+    return wall, latencies, intents, totals
+
+
+def report(wall, latencies, intents, totals, args):
+    events = totals['events']
+    print(f"homes:            {args.homes}")
+    print(f"simulated:        24h in {wall:.1f}s ({DAY_SECONDS / max(wall, 1e-9):.0f}x real time)")
+    print(f"events:           {events} ({events / max(wall, 1e-9):.0f}/s with "
+          f"{args.processes} process(es) x {args.workers} workers)")
+    if events:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        print(f"latency:          p50 {p50:.1f}ms  p90 {p90:.1f}ms  p99 {p99:.1f}ms  max {latencies.max() * 1000:.1f}ms")
+    if args.http:
+        print("db lock retries:  not measured over HTTP")
+    else:
+        print(f"db lock retries:  {totals['lock_retries']} ({totals['lock_retries'] / max(events, 1):.2%} of events), "
+              f"{totals['lock_wait']:.1f}s waiting")
+    print(f"failed:           {totals['failed']}")
+    print("by intent:        " + ', '.join(f'{intent} {count}' for intent, count in intents.most_common()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a day of household activity against the app.')
+    parser.add_argument('--homes', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4, help='concurrent command senders per process')
+    parser.add_argument('--processes', type=int, default=1, help='processes to split the homes across')
+    parser.add_argument('--step', type=float, default=300.0, help='simulated seconds per tick (default: 300)')
+    parser.add_argument('--rate', type=float, default=1.5, help='routine commands per awake occupant-hour')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='database URL (default: a scratch SQLite file)')
+    parser.add_argument('--http', metavar='URL', help='send commands to a running server instead of in-process')
+    args = parser.parse_args(argv)
+
+    if args.http and not args.database:
+        parser.error('--http needs --database pointing at the server database')
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'sim.db')
+
+    started = time.perf_counter()
+    usernames, user_ids = provision_homes(args.homes, run_id=int(time.time()))
+    print(f"provisioned:      {args.homes} homes in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    report(*run(usernames, user_ids, args), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import, so point it at scratch databases first
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRATCH = tempfile.mkdtemp(prefix='smart-home-tests-')
+os.environ['DATABASE_URL'] = f'sqlite:///{SCRATCH}/main.db'
+os.environ['HOUSEHOLD_SHARDS'] = f'a=sqlite:///{SCRATCH}/a.db,b=sqlite:///{SCRATCH}/b.db'
+os.environ['MEDIA_ROOT'] = os.path.join(SCRATCH, 'media')
+sys.path.insert(0, ROOT)
+
+import app as smart_home  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    with smart_home.app.app_context():
+        smart_home.db.drop_all()
+        smart_home.db.create_all()
+        yield smart_home.app
+        smart_home.db.session.remove()
+        smart_home.camera_media.stop_all()
+        shutil.rmtree(os.environ['MEDIA_ROOT'], ignore_errors=True)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,164 @@
+"""Moving households between two SQLite shards (see sharding.move_household).
+
+Run from the project directory with ``python -m pytest tests``.
+"""
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+import media
+import sharding
+from app import db, camera_media, use_household, User, Device, AutomationRule, DeviceStateEvent, HouseholdShard
+
+
+def register(client, username):
+    client.post('/register', data={'username': username, 'password': 'pw'})
+    return User.query.filter_by(username=username).one().id
+
+
+def household_on(client, shard, prefix):
+    """Register households until the ring places one on ``shard``."""
+    for i in range(100):
+        user_id = register(client, f'{prefix}{i}')
+        if placement(user_id) == shard:
+            return user_id
+    raise AssertionError(f'No household landed on shard {shard!r}')
+
+
+def placement(user_id):
+    table = HouseholdShard.__table__
+    with db.get_engine().connect() as connection:
+        return connection.execute(table.select().where(table.c.user_id == user_id)).first().shard
+
+
+def household_rows(shard, model, user_id):
+    table = model.__table__
+    with db.shard_engine(shard).connect() as connection:
+        return connection.execute(
+            table.select().where(table.c.user_id == user_id).order_by(table.c.id)
+        ).fetchall()
+
+
+def add_history(user_id, events_per_device=5):
+    """Give the household a rule and settled events, so the move copies them in batches."""
+    use_household(user_id)
+    devices = {device.type: device for device in Device.query.filter_by(user_id=user_id)}
+    db.session.add(AutomationRule(name='Light on motion', user_id=user_id,
+                                  trigger_device_id=devices['camera'].id, trigger_condition='motion',
+                                  action_device_id=devices['light'].id, action_state='on'))
+    start = datetime.utcnow() - timedelta(hours=2)
+    for device in devices.values():
+        for i in range(events_per_device):
+            db.session.add(DeviceStateEvent(device_id=device.id, user_id=user_id, state=f'state {i}',
+                                            changed_at=start + timedelta(minutes=i)))
+    db.session.commit()
+
+
+def test_move_remaps_devices_rules_and_events(client):
+    household_on(client, 'b', 'resident')  # Takes the low ids on the target
+    user_id = household_on(client, 'a', 'mover')
+    add_history(user_id)
+    devices = household_rows('a', Device, user_id)
+    events = household_rows('a', DeviceStateEvent, user_id)
+    rule = household_rows('a', AutomationRule, user_id)[0]
+
+    id_map = sharding.move_household(db, user_id, 'a', 'b', batch_size=3)
+
+    assert placement(user_id) == 'b'
+    assert sorted(id_map) == [device.id for device in devices]
+    assert any(old_id != new_id for old_id, new_id in id_map.items())
+    for model in (Device, AutomationRule, DeviceStateEvent):
+        assert household_rows('a', model, user_id) == []
+
+    moved = {device.id: device for device in household_rows('b', Device, user_id)}
+    assert sorted(moved) == sorted(id_map.values())
+    for device in devices:
+        copy = moved[id_map[device.id]]
+        assert (copy.name, copy.type, copy.state) == (device.name, device.type, device.state)
+
+    assert Counter((id_map[e.device_id], e.state, e.changed_at) for e in events) == Counter(
+        (e.device_id, e.state, e.changed_at) for e in household_rows('b', DeviceStateEvent, user_id))
+
+    moved_rule, = household_rows('b', AutomationRule, user_id)
+    assert moved_rule.trigger_device_id == id_map[rule.trigger_device_id]
+    assert moved_rule.action_device_id == id_map[rule.action_device_id]
+
+
+def test_failed_copy_removes_partial_target(client, monkeypatch):
+    user_id = household_on(client, 'a', 'mover')
+    add_history(user_id)
+    before = {model: household_rows('a', model, user_id) for model in (Device, AutomationRule, DeviceStateEvent)}
+
+    copy_rows = sharding.copy_rows
+    copied = []
+
+    def copy_once(connection, table, rows, id_map):
+        if copied:
+            raise RuntimeError('copy failed')
+        copied.append(len(rows))
+        copy_rows(connection, table, rows, id_map)
+
+    monkeypatch.setattr(sharding, 'copy_rows', copy_once)
+    with pytest.raises(RuntimeError, match='copy failed'):
+        sharding.move_household(db, user_id, 'a', 'b', batch_size=3)
+
+    assert copied  # The failure came after part of the household reached the target
+    assert placement(user_id) == 'a'
+    for model, rows in before.items():
+        assert household_rows('a', model, user_id) == rows
+        assert household_rows('b', model, user_id) == []
+
+
+def test_failed_source_commit_puts_placement_back(client):
+    user_id = household_on(client, 'a', 'mover')
+    add_history(user_id)
+    before = {model: household_rows('a', model, user_id) for model in (Device, AutomationRule, DeviceStateEvent)}
+
+    def fail_commit(connection):
+        raise OSError('disk I/O error')
+
+    source = db.shard_engine('a')
+    event.listen(source, 'commit', fail_commit)
+    try:
+        with pytest.raises(OSError):
+            sharding.move_household(db, user_id, 'a', 'b')
+    finally:
+        event.remove(source, 'commit', fail_commit)
+
+    assert placement(user_id) == 'a'
+    for model, rows in before.items():
+        assert household_rows('a', model, user_id) == rows
+        assert household_rows('b', model, user_id) == []
+
+
+def test_camera_media_follows_moved_camera(client):
+    household_on(client, 'b', 'resident')
+    user_id = household_on(client, 'a', 'mover')
+    camera = next(device for device in household_rows('a', Device, user_id) if device.type == 'camera')
+    old_dir = camera_media.camera_dir(media.camera_key(user_id, camera.id))
+    os.makedirs(old_dir)
+    with open(os.path.join(old_dir, 'clip.bin'), 'wb') as f:
+        f.write(b'frames')
+
+    with camera_media.lock_household(user_id):
+        id_map = sharding.move_household(db, user_id, 'a', 'b')
+        camera_media.rekey_household(user_id, id_map)
+
+    assert id_map[camera.id] != camera.id
+    new_dir = camera_media.camera_dir(media.camera_key(user_id, id_map[camera.id]))
+    with open(os.path.join(new_dir, 'clip.bin'), 'rb') as f:
+        assert f.read() == b'frames'
+    assert not os.path.exists(old_dir)
+
+
+def test_recording_camera_blocks_household_lock(client):
+    user_id = household_on(client, 'a', 'mover')
+    camera = next(device for device in household_rows('a', Device, user_id) if device.type == 'camera')
+    camera_media.apply_state(media.camera_key(user_id, camera.id), 'recording')
+
+    with pytest.raises(RuntimeError):
+        with camera_media.lock_household(user_id):
+            pass